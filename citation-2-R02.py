@@ -1,8 +1,15 @@
+import functools
 import re
 import sys
 
 # python citation-2-r02.py bib.txt text_extract.txt output_report.txt
 
+# 預先編譯的正規表示式（避免每次呼叫都經過 re 的快取查詢）
+YEAR_RE = re.compile(r'[（(](\d{4})[）)]')          # 年份括號（半形/全形）
+TOKEN_RE = re.compile(r'[\u4e00-\u9fff]{2,}|\b[a-zA-Z]{2,}\b')  # 中文詞 | 英文詞（單次掃描，已排除 <2 字）
+TRAIL_PUNCT_RE = re.compile(r'[.,;，。；、]\s*$')    # 結尾標點
+NON_WORD_RE = re.compile(r'[^\w\u4e00-\u9fff]')     # fallback 用：非文字字元
+
 def extract_bib_entries_full_line_context(bib_file):
     """
     從 bibliography 提取每筆：年份 + 年份前整行文字（到上一行換行）作為關鍵上下文
@@ -10,31 +17,30 @@ def extract_bib_entries_full_line_context(bib_file):
     """
     entries = []
     try:
-        with open(bib_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+        f = open(bib_file, 'r', encoding='utf-8')
     except FileNotFoundError:
         print(f"錯誤：找不到 bibliography 檔案 '{bib_file}'")
         sys.exit(1)
     
-    # 按行分割，但保留空行作為分隔
-    lines = content.splitlines()
-    
+    # 逐行讀取，不必先把整個檔案讀入再分割
     current_entry = ""
-    for line in lines:
-        stripped = line.strip()
-        
-        # 偵測是否為新條目開始（非空且包含年份括號）
-        if stripped and re.search(r'[（(]\d{4}[）)]', stripped):
-            # 如果已有正在處理的條目，先儲存
-            if current_entry:
-                process_entry(current_entry, entries)
+    with f:
+        for line in f:
+            stripped = line.strip()
             
-            # 開始新條目
-            current_entry = stripped
-        elif current_entry and stripped:
-            # 屬於同一條目（多行情況，如學位論文）
-            current_entry += " " + stripped
-        # 空行或無年份 → 暫不處理（避免誤抓標題如「專書」「期刊論文」）
+            # 偵測是否為新條目開始（非空且包含年份括號）
+            # 先用 in 排除沒有括號的行（標題、續行），再交給正規表示式
+            if stripped and ('(' in stripped or '（' in stripped) and YEAR_RE.search(stripped):
+                # 如果已有正在處理的條目，先儲存
+                if current_entry:
+                    process_entry(current_entry, entries)
+                
+                # 開始新條目
+                current_entry = stripped
+            elif current_entry and stripped:
+                # 屬於同一條目（多行情況，如學位論文）
+                current_entry += " " + stripped
+            # 空行或無年份 → 暫不處理（避免誤抓標題如「專書」「期刊論文」）
     
     # 處理最後一筆
     if current_entry:
@@ -42,103 +48,111 @@ def extract_bib_entries_full_line_context(bib_file):
     
     return entries
 
+@functools.lru_cache(maxsize=8192)
+def extract_keywords(text):
+    """
+    提取關鍵詞（中文詞 + 英文詞）：去重、英文詞轉小寫（短詞已由 TOKEN_RE 排除）
+    相同文字（如同一作者的多筆文獻）重複出現時直接取用快取結果
+    """
+    # 中文詞無大小寫，只對英文詞 lower()
+    return frozenset(w.lower() if w[0] < '\u0080' else w for w in TOKEN_RE.findall(text))
+
 def process_entry(entry_line, entries):
     """處理單一文獻條目，提取年份與前方全文關鍵詞"""
     # 支援半形與全形括號
-    year_match = re.search(r'[（(](\d{4})[）)]', entry_line)
+    year_match = YEAR_RE.search(entry_line)
     if not year_match:
         return
     year = year_match.group(1)
     
-    # 找到左括號位置
-    left_bracket = year_match.group(0)[0]
-    bracket_pos = entry_line.find(left_bracket + year)
-    if bracket_pos == -1:
-        return
+    # 左括號位置即為比對起點
+    bracket_pos = year_match.start()
     
     # 關鍵上下文：年份括號前所有文字（整筆開頭到年份前）
     pre_full_text = entry_line[:bracket_pos].strip()
     
     # 清理結尾標點
-    pre_full_text = re.sub(r'[.,;，。；、]\s*$', '', pre_full_text)
+    pre_full_text = TRAIL_PUNCT_RE.sub('', pre_full_text)
     
     # 提取關鍵詞（中文詞 + 英文詞）
-    words = []
-    words.extend(re.findall(r'[\u4e00-\u9fff]+', pre_full_text))  # 中文詞
-    words.extend(re.findall(r'\b[a-zA-Z]+\b', pre_full_text))     # 英文詞
-    
-    # 去重、轉小寫、過濾短詞（<2）
-    keywords = {w.lower() for w in words if len(w) >= 2}
+    keywords = extract_keywords(pre_full_text)
     
     # fallback：若無詞，至少保留部分文字（如作者姓）
     if not keywords and pre_full_text:
-        fallback = re.sub(r'[^\w\u4e00-\u9fff]', '', pre_full_text)[:10].lower()
-        keywords = {fallback} if fallback else set()
-    
-    # 顯示用：前幾個關鍵詞 + 截斷前文
-    display_pre = pre_full_text[:60] + "..." if len(pre_full_text) > 60 else pre_full_text
+        fallback = NON_WORD_RE.sub('', pre_full_text)[:10].lower()
+        keywords = frozenset({fallback}) if fallback else frozenset()
     
     entries.append({
         'original_line': entry_line,
         'year': year,
         'pre_full_text': pre_full_text,           # 完整前方文字
-        'keywords': keywords,                    # 用於匹配
-        'display_pre': display_pre,
-        'top_keywords': list(keywords)[:8]        # 顯示用
+        'keywords': keywords                     # 用於匹配
     })
 
+def format_display_pre(pre_full_text):
+    """顯示用：截斷前文（只在輸出報告時才計算）"""
+    return pre_full_text[:60] + "..." if len(pre_full_text) > 60 else pre_full_text
+
 def find_matches_by_full_pretext(extracted_file, bib_entries):
     """
     在提取結果中：年份出現 + 前方全文關鍵詞任一出現 → match
     """
     try:
         with open(extracted_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+            # 邊讀邊過濾，不保留整份檔案的行清單
+            snippets = [line.strip() for line in f if '[' in line and ']' in line]
     except FileNotFoundError:
         print(f"錯誤：找不到提取結果檔案 '{extracted_file}'")
         sys.exit(1)
     
-    snippets = [line.strip() for line in lines if '[' in line and ']' in line]
+    # 每個 snippet 只斷詞一次，供所有文獻條目共用
+    # （斷詞是主要成本，但不分派給多個行程：把結果 set 傳回主行程的 pickle 成本
+    #   與斷詞本身相當，一般論文的提取結果也只有數百行）
+    snippet_tokens = [extract_keywords(snippet) for snippet in snippets]
+    
+    # 關鍵詞 → 文獻條目索引：每個 snippet 的詞只需查表一次，不必逐筆文獻做交集
+    keyword_to_entry_ids = {}
+    for eid, entry in enumerate(bib_entries):
+        for kw in entry['keywords']:
+            keyword_to_entry_ids.setdefault(kw, []).append(eid)
+    
+    # 依 entry id 排列的平行清單，迴圈內直接以索引取值，不必每次查 dict
+    entry_years = [entry['year'] for entry in bib_entries]
+    entry_snippet_ids = [[] for _ in bib_entries]
+    entry_matched_keywords = [set() for _ in bib_entries]
+    for i, snippet_words in enumerate(snippet_tokens):
+        snippet = snippets[i]
+        # 每個詞只查表一次；str 會快取自身的 hash，長詞也不會重複計算，
+        # 因此不需改用排序後的雙指標交集
+        for w in snippet_words:
+            for eid in keyword_to_entry_ids.get(w, ()):
+                # 必須包含該文獻的年份；只對關鍵詞命中者做子字串檢查（C 層級掃描）
+                if entry_years[eid] not in snippet:
+                    continue
+                hits = entry_snippet_ids[eid]
+                if not hits or hits[-1] != i:
+                    hits.append(i)
+                entry_matched_keywords[eid].add(w)
     
     matches = []
     not_found = []
     
-    for entry in bib_entries:
-        year = entry['year']
-        keywords = entry['keywords']
-        
-        matched_snippets = []
-        matched_keywords_set = set()
-        
-        for snippet in snippets:
-            if year not in snippet:
-                continue
-            
-            snippet_words = set()
-            snippet_words.update(re.findall(r'[\u4e00-\u9fff]+', snippet))
-            snippet_words.update(re.findall(r'\b[a-zA-Z]+\b', snippet))
-            snippet_words = {w.lower() for w in snippet_words if len(w) >= 2}
-            
-            common = keywords & snippet_words
-            if common:
-                matched_snippets.append(snippet)
-                matched_keywords_set.update(common)
-        
-        if matched_snippets:
+    for eid, entry in enumerate(bib_entries):
+        if entry_snippet_ids[eid]:
             matches.append({
                 'bib': entry,
-                'evidence': matched_snippets,
-                'matched_keywords': list(matched_keywords_set)
+                'evidence': [snippets[i] for i in entry_snippet_ids[eid]],
+                'matched_keywords': list(entry_matched_keywords[eid])
             })
         else:
             not_found.append(entry)
     
     return matches, not_found
 def print_and_write(f, text=""):
-    """同時輸出到螢幕和檔案"""
-    print(text)
+    """同時輸出到螢幕和檔案（先寫檔，螢幕編碼不支援時檔案仍完整）"""
     if f:
         f.write(text + '\n')
+    print(text)
 
 def main():
     # 檢查參數數量，現在需要一個可選的輸出檔案名稱
@@ -158,15 +172,16 @@ def main():
     # 設置輸出流
     # 如果提供了 output_file，我們將使用它來寫入結果
     output_f = None
+    report_lines = []
     try:
         if output_file:
             # 使用 io.TextIOWrapper 確保編碼
             output_f = open(output_file, 'w', encoding='utf-8')
             print(f"結果將同時輸出到螢幕和檔案: {output_file}\n")
 
-        # 使用一個簡單的函式來處理所有的輸出
+        # 所有輸出先收集起來，最後一次輸出到螢幕和檔案
         def log_output(text=""):
-            print_and_write(output_f, text)
+            report_lines.append(text)
 
         # ----------------- 腳本核心邏輯 -----------------
         
@@ -192,7 +207,7 @@ def main():
             log_output("【已匹配的文獻】")
             for i, item in enumerate(matches, 1):
                 bib = item['bib']
-                log_output(f"{i:3d}. [{bib['year']}] {bib['display_pre']}")
+                log_output(f"{i:3d}. [{bib['year']}] {format_display_pre(bib['pre_full_text'])}")
                 log_output(f"     匹配關鍵詞：{', '.join(item['matched_keywords'][:10])}")
                 log_output(f"     參考文獻：{bib['original_line'][:120]}...")
                 log_output("     正文證據（前2筆）：")
@@ -203,9 +218,10 @@ def main():
         if not_found:
             log_output("【正文中未找到匹配的文獻（建議檢查是否真的被引用）】")
             for i, item in enumerate(not_found, 1):
-                log_output(f"{i:3d}. [{item['year']}] {item['display_pre']}")
-                if item['top_keywords']:
-                    log_output(f"     期望關鍵詞（前8）：{', '.join(item['top_keywords'])}")
+                log_output(f"{i:3d}. [{item['year']}] {format_display_pre(item['pre_full_text'])}")
+                top_keywords = list(item['keywords'])[:8]
+                if top_keywords:
+                    log_output(f"     期望關鍵詞（前8）：{', '.join(top_keywords)}")
                 log_output(f"     完整條目：{item['original_line'][:120]}...")
                 log_output()
         
@@ -216,6 +232,13 @@ def main():
         print(f"\n發生錯誤: {e}", file=sys.stderr)
 
     finally:
+        # 輸出已收集的報告（即使中途出錯或結束也會輸出）
+        # 輸出本身出錯（如螢幕編碼不支援）時同樣只顯示錯誤訊息，並繼續關閉檔案
+        try:
+            if report_lines:
+                print_and_write(output_f, "\n".join(report_lines))
+        except Exception as e:
+            print(f"\n發生錯誤: {e}", file=sys.stderr)
         # 確保無論如何都會關閉檔案
         if output_f:
             output_f.close()
@@ -234,10 +257,11 @@ import io
 def print_and_write(f, text=""):
     """
     同時將內容輸出到 sys.stdout (螢幕) 和檔案物件 f。
+    先寫入檔案，即使螢幕編碼（如 cp950）無法輸出某些字元，檔案內容仍完整。
     """
-    print(text)
     if f:
         f.write(text + '\n')
+    print(text)
 
 # ----------------- 參考文獻提取函式 -----------------
 
@@ -248,31 +272,30 @@ def extract_bib_entries_full_line_context(bib_file):
     """
     entries = []
     try:
-        with open(bib_file, 'r', encoding='utf-8') as f:
-            content = f.read()
+        f = open(bib_file, 'r', encoding='utf-8')
     except FileNotFoundError:
         print(f"錯誤：找不到 bibliography 檔案 '{bib_file}'", file=sys.stderr)
         sys.exit(1)
     
-    # 按行分割，但保留空行作為分隔
-    lines = content.splitlines()
-    
+    # 逐行讀取，不必先把整個檔案讀入再分割
     current_entry = ""
-    for line in lines:
-        stripped = line.strip()
-        
-        # 偵測是否為新條目開始（非空且包含年份括號）
-        if stripped and re.search(r'[（(]\d{4}[）)]', stripped):
-            # 如果已有正在處理的條目，先儲存
-            if current_entry:
-                process_entry(current_entry, entries)
+    with f:
+        for line in f:
+            stripped = line.strip()
             
-            # 開始新條目
-            current_entry = stripped
-        elif current_entry and stripped:
-            # 屬於同一條目（多行情況，如學位論文）
-            current_entry += " " + stripped
-        # 空行或無年份 → 暫不處理（避免誤抓標題如「專書」「期刊論文」）
+            # 偵測是否為新條目開始（非空且包含年份括號）
+            # 先用 in 排除沒有括號的行（標題、續行），再交給正規表示式
+            if stripped and ('(' in stripped or '（' in stripped) and YEAR_RE.search(stripped):
+                # 如果已有正在處理的條目，先儲存
+                if current_entry:
+                    process_entry(current_entry, entries)
+                
+                # 開始新條目
+                current_entry = stripped
+            elif current_entry and stripped:
+                # 屬於同一條目（多行情況，如學位論文）
+                current_entry += " " + stripped
+            # 空行或無年份 → 暫不處理（避免誤抓標題如「專書」「期刊論文」）
     
     # 處理最後一筆
     if current_entry:
@@ -280,51 +303,51 @@ def extract_bib_entries_full_line_context(bib_file):
     
     return entries
 
+@functools.lru_cache(maxsize=8192)
+def extract_keywords(text):
+    """
+    提取關鍵詞（中文詞 + 英文詞）：去重、英文詞轉小寫（短詞已由 TOKEN_RE 排除）
+    相同文字（如同一作者的多筆文獻）重複出現時直接取用快取結果
+    """
+    # 中文詞無大小寫，只對英文詞 lower()
+    return frozenset(w.lower() if w[0] < '\u0080' else w for w in TOKEN_RE.findall(text))
+
 def process_entry(entry_line, entries):
     """處理單一文獻條目，提取年份與前方全文關鍵詞"""
     # 支援半形與全形括號
-    year_match = re.search(r'[（(](\d{4})[）)]', entry_line)
+    year_match = YEAR_RE.search(entry_line)
     if not year_match:
         return
     year = year_match.group(1)
     
-    # 找到左括號位置
-    left_bracket = year_match.group(0)[0]
-    bracket_pos = entry_line.find(left_bracket + year)
-    if bracket_pos == -1:
-        return
+    # 左括號位置即為比對起點
+    bracket_pos = year_match.start()
     
     # 關鍵上下文：年份括號前所有文字（整筆開頭到年份前）
     pre_full_text = entry_line[:bracket_pos].strip()
     
     # 清理結尾標點
-    pre_full_text = re.sub(r'[.,;，。；、]\s*$', '', pre_full_text)
+    pre_full_text = TRAIL_PUNCT_RE.sub('', pre_full_text)
     
     # 提取關鍵詞（中文詞 + 英文詞）
-    words = []
-    words.extend(re.findall(r'[\u4e00-\u9fff]+', pre_full_text))  # 中文詞
-    words.extend(re.findall(r'\b[a-zA-Z]+\b', pre_full_text))    # 英文詞
-    
-    # 去重、轉小寫、過濾短詞（<2）
-    keywords = {w.lower() for w in words if len(w) >= 2}
+    keywords = extract_keywords(pre_full_text)
     
     # fallback：若無詞，至少保留部分文字（如作者姓）
     if not keywords and pre_full_text:
-        fallback = re.sub(r'[^\w\u4e00-\u9fff]', '', pre_full_text)[:10].lower()
-        keywords = {fallback} if fallback else set()
-    
-    # 顯示用：前幾個關鍵詞 + 截斷前文
-    display_pre = pre_full_text[:60] + "..." if len(pre_full_text) > 60 else pre_full_text
+        fallback = NON_WORD_RE.sub('', pre_full_text)[:10].lower()
+        keywords = frozenset({fallback}) if fallback else frozenset()
     
     entries.append({
         'original_line': entry_line,
         'year': year,
         'pre_full_text': pre_full_text,             # 完整前方文字
-        'keywords': keywords,                       # 用於匹配
-        'display_pre': display_pre,
-        'top_keywords': list(keywords)[:8]          # 顯示用
+        'keywords': keywords                        # 用於匹配
     })
 
+def format_display_pre(pre_full_text):
+    """顯示用：截斷前文（只在輸出報告時才計算）"""
+    return pre_full_text[:60] + "..." if len(pre_full_text) > 60 else pre_full_text
+
 # ----------------- 正文匹配函式 -----------------
 
 def find_matches_by_full_pretext(extracted_file, bib_entries):
@@ -333,46 +356,51 @@ def find_matches_by_full_pretext(extracted_file, bib_entries):
     """
     try:
         with open(extracted_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+            # 只處理包含潛在引文標記的行 (e.g., [Year] or [Author, Year])
+            # 邊讀邊過濾，不保留整份檔案的行清單
+            snippets = [line.strip() for line in f if '[' in line and ']' in line]
     except FileNotFoundError:
         print(f"錯誤：找不到提取結果檔案 '{extracted_file}'", file=sys.stderr)
         sys.exit(1)
     
-    # 只處理包含潛在引文標記的行 (e.g., [Year] or [Author, Year])
-    snippets = [line.strip() for line in lines if '[' in line and ']' in line]
+    # 每個 snippet 只斷詞一次，供所有文獻條目共用
+    # （斷詞是主要成本，但不分派給多個行程：把結果 set 傳回主行程的 pickle 成本
+    #   與斷詞本身相當，一般論文的提取結果也只有數百行）
+    snippet_tokens = [extract_keywords(snippet) for snippet in snippets]
+    
+    # 關鍵詞 → 文獻條目索引：每個 snippet 的詞只需查表一次，不必逐筆文獻做交集
+    keyword_to_entry_ids = {}
+    for eid, entry in enumerate(bib_entries):
+        for kw in entry['keywords']:
+            keyword_to_entry_ids.setdefault(kw, []).append(eid)
+    
+    # 依 entry id 排列的平行清單，迴圈內直接以索引取值，不必每次查 dict
+    entry_years = [entry['year'] for entry in bib_entries]
+    entry_snippet_ids = [[] for _ in bib_entries]
+    entry_matched_keywords = [set() for _ in bib_entries]
+    for i, snippet_words in enumerate(snippet_tokens):
+        snippet = snippets[i]
+        # 每個詞只查表一次；str 會快取自身的 hash，長詞也不會重複計算，
+        # 因此不需改用排序後的雙指標交集
+        for w in snippet_words:
+            for eid in keyword_to_entry_ids.get(w, ()):
+                # 必須包含該文獻的年份；只對關鍵詞命中者做子字串檢查（C 層級掃描）
+                if entry_years[eid] not in snippet:
+                    continue
+                hits = entry_snippet_ids[eid]
+                if not hits or hits[-1] != i:
+                    hits.append(i)
+                entry_matched_keywords[eid].add(w)
     
     matches = []
     not_found = []
     
-    for entry in bib_entries:
-        year = entry['year']
-        keywords = entry['keywords']
-        
-        matched_snippets = []
-        matched_keywords_set = set()
-        
-        for snippet in snippets:
-            # 必須包含年份
-            if year not in snippet:
-                continue
-            
-            # 提取 snippet 中的所有關鍵詞
-            snippet_words = set()
-            snippet_words.update(re.findall(r'[\u4e00-\u9fff]+', snippet))
-            snippet_words.update(re.findall(r'\b[a-zA-Z]+\b', snippet))
-            snippet_words = {w.lower() for w in snippet_words if len(w) >= 2}
-            
-            # 尋找文獻關鍵詞與 snippet 關鍵詞的交集
-            common = keywords & snippet_words
-            if common:
-                matched_snippets.append(snippet)
-                matched_keywords_set.update(common)
-        
-        if matched_snippets:
+    for eid, entry in enumerate(bib_entries):
+        if entry_snippet_ids[eid]:
             matches.append({
                 'bib': entry,
-                'evidence': matched_snippets,
-                'matched_keywords': list(matched_keywords_set)
+                'evidence': [snippets[i] for i in entry_snippet_ids[eid]],
+                'matched_keywords': list(entry_matched_keywords[eid])
             })
         else:
             not_found.append(entry)
@@ -399,15 +427,16 @@ def main():
 
     # 設置輸出流
     output_f = None
+    report_lines = []
     try:
         if output_file:
             # 開啟檔案，使用 'w' 寫入模式和 'utf-8' 編碼
             output_f = open(output_file, 'w', encoding='utf-8')
             print(f"結果將同時輸出到螢幕和檔案: {output_file}\n")
 
-        # 使用一個簡單的函式來處理所有的輸出，使其導向 print_and_write
+        # 所有輸出先收集起來，最後由 print_and_write 一次輸出到螢幕和檔案
         def log_output(text=""):
-            print_and_write(output_f, text)
+            report_lines.append(text)
 
         # ----------------- 腳本核心邏輯 -----------------
         
@@ -434,7 +463,7 @@ def main():
             log_output("【已匹配的文獻】")
             for i, item in enumerate(matches, 1):
                 bib = item['bib']
-                log_output(f"{i:3d}. [{bib['year']}] {bib['display_pre']}")
+                log_output(f"{i:3d}. [{bib['year']}] {format_display_pre(bib['pre_full_text'])}")
                 log_output(f"     匹配關鍵詞：{', '.join(item['matched_keywords'][:10])}")
                 log_output(f"     參考文獻：{bib['original_line'][:120]}...")
                 log_output("     正文證據（前2筆）：")
@@ -446,9 +475,10 @@ def main():
         if not_found:
             log_output("【正文中未找到匹配的文獻（建議檢查是否真的被引用）】")
             for i, item in enumerate(not_found, 1):
-                log_output(f"{i:3d}. [{item['year']}] {item['display_pre']}")
-                if item['top_keywords']:
-                    log_output(f"     期望關鍵詞（前8）：{', '.join(item['top_keywords'])}")
+                log_output(f"{i:3d}. [{item['year']}] {format_display_pre(item['pre_full_text'])}")
+                top_keywords = list(item['keywords'])[:8]
+                if top_keywords:
+                    log_output(f"     期望關鍵詞（前8）：{', '.join(top_keywords)}")
                 log_output(f"     完整條目：{item['original_line'][:120]}...")
                 log_output()
         
@@ -459,6 +489,13 @@ def main():
         print(f"\n執行過程中發生未預期錯誤: {e}", file=sys.stderr)
 
     finally:
+        # 輸出已收集的報告（即使中途出錯或結束也會輸出）
+        # 輸出本身出錯（如螢幕編碼不支援）時同樣只顯示錯誤訊息，並繼續關閉檔案
+        try:
+            if report_lines:
+                print_and_write(output_f, "\n".join(report_lines))
+        except Exception as e:
+            print(f"\n執行過程中發生未預期錯誤: {e}", file=sys.stderr)
         # 確保無論程式是否成功運行，檔案都會被關閉
         if output_f:
             output_f.close()
@@ -4,35 +4,38 @@ import os
 
 # python citation-R01.py text.txt
 
+# 預先編譯的年份樣式（不需要捕獲群組，group(0) 即為年份）
+YEAR_RE = re.compile(r'\b(?:19|20)\d{2}\b')
+
 def extract_years_with_fixed_context(text, context_chars=30):
     """
     提取所有 19xx 或 20xx 年份，前後固定提取 context_chars 個字元
+    相同年份 + 相同完整片段只保留第一次出現
+    回傳 (去重後的 (year, context_start, start, end, context_end) 清單, 年份出現總次數)
     """
-    pattern = r'\b(19\d{2}|20\d{2})\b'
     matches = []
+    seen = set()
+    total = 0
+    text_len = len(text)
     
-    for match in re.finditer(pattern, text):
+    for match in YEAR_RE.finditer(text):
+        total += 1
         year = match.group(0)
-        start = match.start()
-        end = match.end()
+        start, end = match.span()
         
-        # 提取上下文
+        # 只記錄上下文範圍，不預先切出字串
         context_start = max(0, start - context_chars)
-        context_end = min(len(text), end + context_chars)
+        context_end = min(text_len, end + context_chars)
         
-        before = text[context_start:start]
-        after = text[end:context_end]
-        snippet = text[context_start:context_end]
+        # 去重：相同年份 + 相同完整片段 只保留一次
+        key = (year, text[context_start:context_end])
+        if key in seen:
+            continue
+        seen.add(key)
         
-        matches.append({
-            'year': year,
-            'snippet': snippet,
-            'before': before,
-            'after': after,
-            'position': start
-        })
+        matches.append((year, context_start, start, end, context_end))
     
-    return matches
+    return matches, total
 
 def main(paper_file):
     if not os.path.exists(paper_file):
@@ -43,7 +46,7 @@ def main(paper_file):
         with open(paper_file, 'r', encoding='utf-8') as f:
             text = f.read()
         
-        results = extract_years_with_fixed_context(text, context_chars=30)
+        results, total = extract_years_with_fixed_context(text, context_chars=30)
         
         # 輸出檔案名稱
         base_name = os.path.basename(paper_file)
@@ -53,23 +56,16 @@ def main(paper_file):
             out_f.write("西元年份提取結果（前後各 30 字元）\n")
             out_f.write("=" * 80 + "\n")
             out_f.write(f"來源檔案：{paper_file}\n")
-            out_f.write(f"共找到 {len(results)} 處年份出現\n")
+            out_f.write(f"共找到 {total} 處年份出現\n")
             out_f.write(f"輸出時間：{__import__('datetime').datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
             out_f.write("=" * 80 + "\n\n")
             
-            # 去重：相同年份 + 相同完整片段 只顯示一次
-            seen = set()
-            displayed_count = 0
-            
-            for i, item in enumerate(results, 1):
-                key = (item['year'], item['snippet'])
-                if key in seen:
-                    continue
-                seen.add(key)
-                displayed_count += 1
-                
-                line = f"{displayed_count:3d}. ...{item['before']}[{item['year']}] {item['after']}...\n"
-                out_f.write(line)
+            # results 已於提取時去重；組好所有行後一次寫入
+            lines = [
+                f"{displayed_count:3d}. ...{text[context_start:start]}[{year}] {text[end:context_end]}...\n"
+                for displayed_count, (year, context_start, start, end, context_end) in enumerate(results, 1)
+            ]
+            out_f.write("".join(lines))
             
             out_f.write("\n" + "=" * 80 + "\n")
             out_f.write("說明：\n")
@@ -79,7 +75,7 @@ def main(paper_file):
             out_f.write("  - 建議用此結果手動檢查哪些年份出現在括號內，即為 in-text citation\n")
         
         print("提取完成！")
-        print(f"共找到 {len(results)} 處年份（去重後顯示 {displayed_count} 處）")
+        print(f"共找到 {total} 處年份（去重後顯示 {len(results)} 處）")
         print(f"結果已儲存至：{output_file}")
         print("   → 你可以用記事本或文字編輯器開啟查看。")
     